@@ -4,17 +4,46 @@
 測定値がLIMITを下回ると ビープ音を鳴らして、画面を暗転します。
 """
 
+import os
 import sys
 import time
+import signal
+import argparse
 import logging
-import math
+from logging.handlers import MemoryHandler, RotatingFileHandler
+from typing import Union
+from functools import lru_cache
+import numpy as np
 from gpiozero import MCP3202
 from gpiozero.pins.pigpio import PiGPIOFactory
 # 自作 DAQ コントローラ
 import pydaq
 
 # Measure Option
+# --warning で変更できる
 WARNING = 2000
+# (電圧測定チャンネル, 抵抗測定開始チャンネル, 抵抗測定終了チャンネル)
+CHAN = (
+    (120, 101, 113),
+    (220, 201, 213),
+)
+# 制限値の調整刻み 10kΩ
+STEP = 10000
+# ADCのゆらぎを吸収するため、制限値を変えるまでの余裕
+HYSTERESIS = STEP // 4
+# 測定周期 [s]
+INTERVAL = 1.0
+
+
+@lru_cache(maxsize=None)
+def volume_adc() -> MCP3202:
+    """可変抵抗の電圧を読み取るMCP3202を返す。
+    pigpiodへの接続とSPIの初期化は初回呼び出し時に一度だけ行い、
+    以降は同じインスタンスを使い回す。
+    接続はプログラム終了時に pin_factory.close() で閉じる。
+    """
+    factory = PiGPIOFactory()
+    return MCP3202(channel=0, max_voltage=3.3, pin_factory=factory)
 
 
 def read_volume_resistance() -> int:
@@ -27,21 +56,36 @@ def read_volume_resistance() -> int:
 
     typical 200kΩ ~ 1MΩ
     最大3MΩまで設定できる
+
+    STEP単位への丸めは呼び出し側で行うので、ここでは丸めずにΩで返す。
+    valueではなく12bitの生の値を使い、整数演算だけで計算する。
     """
-    step = 10000  # kΩオーダー & step 10kΩ
-    max_val = 3.3e6  # limit調整可能値 <3.3MΩ
-    try:
-        factory = PiGPIOFactory()
-        adc_ch0 = MCP3202(channel=0, max_voltage=3.3, pin_factory=factory)
-        val: float = adc_ch0.value  # 0～1
-    finally:
-        factory.close()
-    kohm: int = math.floor(max_val / step * val**2)  # 0~330 小数点以下切り捨て
+    max_val = 3_300_000  # limit調整可能値 <3.3MΩ
+    full_scale = 4095  # MCP3202は12bit
+    raw: int = volume_adc().raw_value  # 0～4095
     # 指数関数でカーブを付けて低い値で調整しやすく
-    return kohm * step
+    return max_val * raw**2 // full_scale**2  # 0~3.3MΩ 小数点以下切り捨て
+
+
+@lru_cache(maxsize=64)
+def display_limit(step_index: int) -> str:
+    """ 制限値 step_index * STEP をDAQに表示する文字列にする
+    表示は右詰め、kΩ表示、小数点以下切り捨て
+    """
+    return "{:>6d}kOhm".format(step_index * STEP // 1000)
+
+
+@lru_cache(maxsize=None)
+def scan_command(start_chan: int, end_chan: int) -> str:
+    """ 抵抗測定のスキャンリストを切り替えるコマンド
+    チャンネルは固定なので毎回組み立てずに使い回す
+    """
+    return f"ROUT:SCAN (@{start_chan}:{end_chan})"
 
 
-def measure_unless_working(vol: int, start_chan: int, end_chan: int) -> list[float]:
+def measure_unless_working(daq: pydaq.Daq,
+                           vol: int, start_chan: int, end_chan: int
+                           ) -> Union[float, np.ndarray]:
     """ 電圧がかかっていない方のモジュールの抵抗値を測定する
     volで与えられたチャンネルの電圧を測定する
     電圧が10V未満であれば、接続されているので抵抗値を測ってはいけない。
@@ -51,36 +95,52 @@ def measure_unless_working(vol: int, start_chan: int, end_chan: int) -> list[flo
     # 10V以上の電圧があればスイッチが入っているので測らない
     is_working = daq.voltage(vol) > 10
     if is_working:
-        return []
+        return np.empty(0)
+
+    # 抵抗測定の設定は configure_resistance() で済ませてあるので
+    # スキャンリストを切り替えて READ? するだけ
+    return daq.measure(scan_command(start_chan, end_chan), delay=12)
 
+
+def configure_resistance(daq: pydaq.Daq, start_chan: int, end_chan: int,
+                         warning: float = WARNING) -> None:
+    """ start_chanからend_chanの抵抗測定の設定をDAQに一度だけ送る
+    設定はチャンネルごとにDAQ側で保持されるので、
+    voltage()のMEAS?でスキャンリストが変わっても毎回送り直す必要はない。
+    """
+    chs = f"(@{start_chan}:{end_chan})"
     cmd = (
-        "CONF:RES 10E6,10, (@{}:{})".format(start_chan, end_chan),
-        "RES:NPLC 1",
+        f"CONF:RES 10E6,10, {chs}",
+        f"RES:NPLC 1, {chs}",
         # Warning message on DAQ970A
-        f"CALC:LIMIT:LOW {WARNING}",
-        "CALC:LIMIT:LOW:STATE ON",
+        f"CALC:LIMIT:LOW {warning}, {chs}",
+        f"CALC:LIMIT:LOW:STATE ON, {chs}",
     )
-    return daq.measure(*cmd, delay=12)
+    daq.write(pydaq.Daq.join_command(*cmd))
 
-def error_check(index:int, res: list[float], limit:float) -> None:
+def error_check(daq: pydaq.Daq, index:int, res: Union[float, np.ndarray],
+                limit:float, warning: float = WARNING) -> None:
     """ resの返り値の内１つでもlimitを下回ったらBeep
+    resはfloat 1つでも空の配列でもよい。
     """
-    log_msg: str = ",".join(str(i) for i in [index] + res)
+    # 比較をまとめて行うためにndarrayに変換
+    arr = np.atleast_1d(np.asarray(res, dtype=float))
+    # tolist()でPythonのfloatに戻してからC実装のmap(str)で文字列化
+    log_msg: str = ",".join(map(str, [index, *arr.tolist()]))
     # resの返り値の内１つでもlimitを下回ったら
-    if any(r < limit for r in res):
+    if (arr < limit).any():
         # Display ERROR message on DAQ970A
         # Beep と画面暗転
-        daq.write("SYSTEM:BEEP")
-        daq.write("DISP:TEXT '[ CAUTION ]\nSHUTDOWN THE SYSTEM'")
+        daq.display("[ CAUTION ]\nSHUTDOWN THE SYSTEM", "SYSTEM:BEEP")
         logger.error(log_msg)
-    # resの返り値の内１つでもWARNINGを下回ったら
-    elif any(r < WARNING for r in res):
+    # resの返り値の内１つでもwarningを下回ったら
+    elif (arr < warning).any():
         # warning, info levelのときは画面暗転を解除
-        daq.write("DISP:TEXT:CLEAR")
+        daq.display(None)
         logger.warning(log_msg)
     else:
         # warning, info levelのときは画面暗転を解除
-        daq.write("DISP:TEXT:CLEAR")
+        daq.display(None)
         logger.info(log_msg)
 
 class CustomFormatter(logging.Formatter):
@@ -91,6 +151,46 @@ class CustomFormatter(logging.Formatter):
         return super().format(record)
 
 
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """64KBのバッファにためてから書き込むRotatingFileHandler
+    レコードごとのflushを行わず、バッファが一杯になったとき、
+    ERROR以上のログのとき、flush()/close()のときにだけ書き込む。
+    ローテーションの判定はseek()でバッファが吐き出されないように
+    書き込んだバイト数を数えて行う。
+    """
+    buffer_size = 1 << 16
+
+    def _open(self):
+        stream = open(self.baseFilename, self.mode, buffering=self.buffer_size,
+                      encoding=self.encoding, errors=self.errors)
+        self.written = os.path.getsize(self.baseFilename)
+        return stream
+
+    def emit(self, record):
+        # StreamHandler.emit()と違い毎回はflushしない
+        try:
+            if self.stream is None:  # delay=True で初回はまだ開いていない
+                self.stream = self._open()
+            # フォーマットは1回だけ行い、ローテーションの判定と書き込みに使う
+            msg = self.format(record) + self.terminator
+            size = len(msg.encode(self.encoding or "utf-8",
+                                  self.errors or "strict"))
+            # 通常ファイル以外(/dev/stdoutやシンボリックリンク先のデバイスなど)は
+            # ローテーションしない (RotatingFileHandlerと同じくbpo-45401に従う)
+            if (0 < self.maxBytes <= self.written + size
+                    and not (os.path.exists(self.baseFilename)
+                             and not os.path.isfile(self.baseFilename))):
+                self.doRollover()
+                if self.stream is None:  # ローテーション直後
+                    self.stream = self._open()
+            self.stream.write(msg)
+            self.written += size
+            if record.levelno >= logging.ERROR:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+
 # Logging option
 # Set log level
 logger = logging.getLogger(__name__)
@@ -104,45 +204,108 @@ stream_handler.setLevel(logging.DEBUG)
 formatter = CustomFormatter("[ %(levelname)s ] %(asctime)s,%(message)s")
 stream_handler.setFormatter(formatter)
 
+# 毎回書き込まずにLOG_CAPACITY件ためてから書き出す
+# ERROR以上のログはその場でためていたログと一緒に書き出す
+# 件数がたまらなくてもLOG_FLUSH_INTERVAL秒ごとに書き出す
+LOG_CAPACITY = 64
+LOG_FLUSH_INTERVAL = 60.0
+memory_handler = MemoryHandler(
+    LOG_CAPACITY, flushLevel=logging.ERROR, target=stream_handler)
+
 # Add handlers to logger
-logger.addHandler(stream_handler)
-
-# Initialize instruments
-try:
-    daq = pydaq.Daq()
-except BaseException as e:
-    logger.critical(e)
-    sys.exit(1)
-
-try:
-    limit: int = 0
-    while True:
-        # 10Vかかっていない方のモジュールの抵抗値を測定する
-        # float リストか空のリストが返ってくる
-        chan = (
-                (120, 101, 113),
-                (220, 201, 213),
-                )
-        for i,c in enumerate(chan, 1):
-            res = measure_unless_working(*c)
-            error_check(i, res, limit)
-
-
-        # 制限値を可変抵抗の回し角から読み込む
-        new_limit = read_volume_resistance()
-        if limit != new_limit:
-            limit = new_limit
-            # 表示は右詰め、kΩ表示、小数点以下切り捨て
-            display_limit_str = "{:>6d}kOhm".format(int(limit / 1000))
-            logger.debug(f"Limit value changed: {display_limit_str}")
-            daq.write(f"DISP:TEXT 'Set alarm {display_limit_str}'")
-
-        # 毎秒測定
-        time.sleep(1)
-
-finally:
-    # DAQ session handler close
-    daq.write("STATUS:PRESET")
-    daq.write("DISP:TEXT:CLEAR")
-    daq.write("*CLS")
-    daq.close()
+logger.addHandler(memory_handler)
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """コマンドライン引数の解析
+    引数なしで起動したときはモジュールの既定値で動作する。
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--warning", type=float, default=WARNING,
+                        help=f"WARNINGログを出す抵抗値[Ω] (default: {WARNING})")
+    parser.add_argument("--log-file",
+                        help="ログを標準出力ではなくファイルに書き出す"
+                        " (4MBごとに5世代までローテーション)")
+    return parser.parse_args(argv)
+
+
+def flush_log():
+    """ MemoryHandlerにためているログと出力先のバッファを書き出す """
+    memory_handler.flush()
+    memory_handler.target.flush()
+
+
+def main(argv=None):
+    # シャットダウンボタンでOSが送るSIGTERMでもfinallyを通して
+    # ログの書き出しと測定器の後始末を行う
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    args = parse_args(argv)
+    if args.log_file:
+        file_handler = BufferedRotatingFileHandler(
+            args.log_file, maxBytes=4_000_000, backupCount=5,
+            encoding="utf-8", delay=True)
+        file_handler.setLevel(logging.DEBUG)
+        file_handler.setFormatter(formatter)
+        memory_handler.setTarget(file_handler)
+
+    # Initialize instruments
+    try:
+        daq = pydaq.Daq()
+    except BaseException as e:
+        logger.critical(e)
+        sys.exit(1)
+
+    try:
+        limit: int = 0
+        for _, start_chan, end_chan in CHAN:
+            configure_resistance(daq, start_chan, end_chan, args.warning)
+
+        next_tick = time.monotonic()
+        last_flush = next_tick
+        while True:
+            # 10Vかかっていない方のモジュールの抵抗値を測定する
+            # float 配列か空の配列が返ってくる
+            for i,c in enumerate(CHAN, 1):
+                res = measure_unless_working(daq, *c)
+                error_check(daq, i, res, limit, args.warning)
+
+
+            # 制限値を可変抵抗の回し角から読み込む
+            new_limit = read_volume_resistance()
+            # ADCのゆらぎで隣のステップと行き来しないように
+            # 現在のステップの範囲 limit~limit+STEP から
+            # HYSTERESIS以上はみ出したときだけ更新する
+            if (new_limit < limit - HYSTERESIS
+                    or new_limit >= limit + STEP + HYSTERESIS):
+                limit = new_limit // STEP * STEP
+                display_limit_str = display_limit(limit // STEP)
+                logger.debug(f"Limit value changed: {display_limit_str}")
+                daq.display(f"Set alarm {display_limit_str}")
+
+            # 電源断に備えてためているログを定期的に書き出す
+            if time.monotonic() - last_flush >= LOG_FLUSH_INTERVAL:
+                flush_log()
+                last_flush = time.monotonic()
+
+            # 毎秒測定
+            # 処理にかかった時間を差し引いて次の周期まで待つ
+            next_tick += INTERVAL
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # 周期を超えて遅れたら取り戻そうとせずに基準を今に合わせる
+                next_tick = time.monotonic()
+
+    finally:
+        # DAQ session handler close
+        daq.write(pydaq.Daq.join_command("STATUS:PRESET", "DISP:TEXT:CLEAR", "*CLS"))
+        daq.close()
+        # pigpiod session close
+        if volume_adc.cache_info().currsize:
+            volume_adc().pin_factory.close()
+        # 溜まっているログを書き出す
+        flush_log()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ case insensitive なので upper caseでも lower caseでもコマンドを受
 import time
 from typing import Union, Optional
 from enum import Enum
+import numpy as np
 import pyvisa
 
 
@@ -37,8 +38,8 @@ class Daq:
 
     def __init__(self):
         """ リソースの開放
-        ポートをスキャンして
-        USB から始まるポートに割当て。
+        USBの測定器だけをスキャンして
+        最初に見つかったポートに割当て。
 
         インタープリターでやっているときはcloseしないと
         他のセッションからアクセスできなくなるので注意
@@ -46,7 +47,6 @@ class Daq:
         Usage:
             >>> daq = Daq()
             Check resources...
-            ASRL/dev/ttyAMA0::INSTR
             USB0::10893::34305::MY59002752::0::INSTR
             initialize success.
             >>> daq.whoami
@@ -62,16 +62,21 @@ class Daq:
         """
         # Begin finding out the daq resources that are available.
         self.rm = pyvisa.ResourceManager()
-        # Make a variable that is the list of visa devices attached to the computer.
-        resources = self.rm.list_resources()
+        # Make a variable that is the list of USB visa devices attached to the computer.
+        # ASRL(シリアル)などを返り値のリストから除外するだけで、
+        # 列挙そのものが減るわけではない
+        resources = self.rm.list_resources("USB?*INSTR")
         print("Check resources...")
+        if not resources:
+            raise RuntimeError("USB instrument not found")
 
-        for r in resources:
-            print(r)
-            if r.startswith("USB"):
-                self.instr = self.rm.open_resource(r)
-                print("initialize success.")
-                break
+        print(resources[0])
+        self.instr = self.rm.open_resource(resources[0])
+        print("initialize success.")
+
+        # DAQの画面に表示中の文字列 Noneは表示なし
+        # 起動時の表示はわからないので、最初のdisplay()は必ず書き込む
+        self.display_text: Optional[str] = ""
 
         # 型式を取得
         # 'Keysight Technologies,DAQ973A,MY59002752,A.02.02-01.00-02.01-00.02-02.00-03-03\n'
@@ -100,25 +105,41 @@ class Daq:
         return ",".join(str(c) for c in ch)
 
     @staticmethod
-    def parse_float(st: str) -> Union[float, list[float]]:
+    def join_command(*command: str) -> str:
+        """
+        複数のSCPIコマンドを ; で結合して1回のwriteで送れる文字列に変換
+        サブシステムが異なるコマンドを続けられるように
+        2つ目以降のコマンドの先頭には : を付けてルートから解釈させる。
+        *CLS のような共通コマンドには : を付けない。
+        >>> Daq.join_command("CONF:RES 10E6,10, (@101:113)", "RES:NPLC 1", "*CLS")
+        "CONF:RES 10E6,10, (@101:113);:RES:NPLC 1;*CLS"
+        """
+        head, *tail = command
+        return ";".join(
+            [head] + [c if c.startswith((":", "*")) else ":" + c for c in tail])
+
+    @staticmethod
+    def parse_float(st: str) -> Union[float, np.ndarray]:
         """
         '+1.99674538E+03,+2.63265505E+04' という文字列をカンマで区切って
-        floatとして解釈し floatのリストで返す
+        floatとして解釈し ndarrayで返す
+        値が1つだけならfloatで返す
         >>> Daq.parse_float('+1.99674538E+03,+2.63265505E+04' )
-        [1996.74,26326.55]
+        array([ 1996.74538, 26326.5505 ])
         """
-        # rstrip()で\nを削除して,で区切ってfloatリストにする
-        lst = [float(r) for r in st.rstrip().split(",")]
-        if len(lst) < 2:
-            return lst[0]
-        return lst
+        # rstrip()で\nを削除して,で区切ってfloat配列にする
+        # np.fromstring()はNumPy 1.xだと不正な値以降を黙って捨てるので使わない
+        arr = np.array(st.rstrip().split(","), dtype=float)
+        if arr.size < 2:
+            return float(arr[0])
+        return arr
 
     def resistance(
         self,
         *ch: Union[int, str],
         range_: Union[Range, int] = Range.AUTO,
         resolution: Union[Resolution, int] = Resolution.DEF
-    ) -> Union[float, list[float]]:
+    ) -> Union[float, np.ndarray]:
         """ 抵抗測定
         # 1の基板の01の抵抗を測定
         >>> daq.resistance(101)
@@ -151,7 +172,7 @@ class Daq:
         *ch: Union[int, str],
         range_: Union[Range, int] = Range.AUTO,
         resolution: Union[Resolution, int] = Resolution.DEF
-    ) -> Union[float, list[float]]:
+    ) -> Union[float, np.ndarray]:
         """ 抵抗測定
         # 1の基板の01の抵抗を測定
         >>> daq.resistance(101)
@@ -186,14 +207,10 @@ class Daq:
 
         Returns will be raw string included newline "\n".
         """
-        # Write all messages one by one
-        for command in message:
-            self.instr.write(command,
-                    termination=termination,
-                    encoding=encoding)
-
-        # Finally read buffer from instrument
-        self.instr.write("READ?")
+        # Write all messages and READ? at once
+        self.instr.write(Daq.join_command(*message, "READ?"),
+                termination=termination,
+                encoding=encoding)
 
         # Wait for command processing
         if delay > 0.0:
@@ -225,6 +242,27 @@ class Daq:
         """
         return self.instr.write(*args, **kwargs)
 
+    def display(self, text: Optional[str], *command: str):
+        """ DAQの画面にtextを表示する。textがNoneなら表示を消す。
+        前回と同じ表示であれば画面への書き込みは省略する。
+        commandを渡すと表示と一緒に1回のwriteで送る。
+
+        >>> daq.display("Set alarm   1000kOhm")
+        >>> daq.display(None)  # DISP:TEXT:CLEAR
+
+        ビープ音は毎回鳴らし、表示は変わったときだけ書き込む
+        >>> daq.display("[ CAUTION ]", "SYSTEM:BEEP")
+
+        NOTE: write()で直接DISP:TEXTを送ると表示のキャッシュとずれるので、
+        画面表示はこのメソッドを経由すること。
+        """
+        if text != self.display_text:
+            self.display_text = text
+            command += ("DISP:TEXT:CLEAR" if text is None
+                        else f"DISP:TEXT '{text}'",)
+        if command:
+            self.write(Daq.join_command(*command))
+
     def read(self, *args, **kwargs):
         """ Same as daq.instr.read()
         write()したバッファを読み込む。